@@ -1,11 +1,16 @@
 #!/usr/bin/python2
 
 import argparse
+import collections
 import datetime
+import errno
+import multiprocessing
 import os
 import select
 import socket
 import sys
+import traceback
+from multiprocessing import reduction
 
 class ReadOnlyException(Exception):
   pass
@@ -16,6 +21,18 @@ class ConflictingLockException(Exception):
 class NoTransactionException(Exception):
   pass
 
+class InvalidBatchException(Exception):
+  pass
+
+class InvalidSubscriptionException(Exception):
+  pass
+
+class InvalidTimestampException(Exception):
+  pass
+
+class NestingTooDeepException(Exception):
+  pass
+
 class TTDBTable(object):
   """A table and corresponding index for the TT database.
 
@@ -60,55 +77,113 @@ class TTDBTable(object):
       item: Item to be inserted
         Format: (value, timestamp)
     """
+    self.__merge(dictionary, key, [item])
+
+  def __merge(self, dictionary, key, items):
+    """Merge a time sorted run of items into the indicated bucket.
+
+    Items with a write stamp equal to one already in the bucket are placed
+    after it.  The common case of a run that is newer than everything in the
+    bucket is a plain append, so merging costs O(len(items)) rather than the
+    length of the existing chain.
+
+    If autopurge is set, only the last item of the run and any later items
+    already in the bucket are kept.
+
+    Args:
+      dictionary: The dictionary into which to merge items
+      key: The key where to merge items
+      items: Non-empty list of items sorted by write stamp
+        Format: [(value, timestamp), ...]
+    """
+    last = items[-1]
     if key not in dictionary:
-      dictionary[key] = [[item], item[1]]
-    else:
-      items = dictionary[key][0]
-      for i in range(len(items)):
-        if items[i][1] > item[1]:
-          break
-        else:
-          i += 1
       if self.autopurge:
-        dictionary[key] = [[item] + items[i:], item[1]]
+        dictionary[key] = [[last], last[1]]
+      else:
+        dictionary[key] = [list(items), last[1]]
+      return
+
+    chain = dictionary[key][0]
+    if self.autopurge:
+      i = self.__split(chain, last[1])
+      dictionary[key] = [[last] + chain[i:], last[1]]
+    elif chain[-1][1] <= items[0][1]:
+      chain.extend(items)
+      dictionary[key][1] = last[1]
+    else:
+      i = self.__split(chain, items[0][1])
+      merged = chain[:i]
+      j = i
+      for item in items:
+        while j < len(chain) and chain[j][1] <= item[1]:
+          merged.append(chain[j])
+          j += 1
+        merged.append(item)
+      merged.extend(chain[j:])
+      dictionary[key] = [merged, last[1]]
+
+  def __split(self, items, time):
+    """Find the position of the first item written after the given time.
+
+    Args:
+      items: List of items sorted by write stamp
+      time: datetime stamp to split at
+
+    Returns:
+      The index of the first item with a write stamp later than time, or
+      len(items) if there is none
+    """
+    lo, hi = 0, len(items)
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if items[mid][1] > time:
+        hi = mid
       else:
-        dictionary[key] = [items[:i] + [item] + items[i:], item[1]]
+        lo = mid + 1
+    return lo
 
-  def __read_item(self, dictionary, key, break_time):
+  def __read_item(self, dictionary, key, break_time, track_reads=True):
     """Read item from dictionary as it existed at the given time.
 
     If key is in dictionary and the list of items includes at least one item
     with a write stamp earlier than break_time the latest item earlier than
-    break_time is returned and the read timestamp is updated.
+    break_time is returned and, if track_reads is set, the read timestamp is
+    updated.
     Else, None is returned.
 
+    The item is found by binary search, so reading any point in a key's
+    history costs O(log versions).
+
     Args:
       dictionary: The dictionary from which to read item
       key: The key where to read item
       break_time: datetime stamp indicating which snapshot to read
+      track_reads: (keyword) A boolean representing whether to update the read timestamp.  Only needed when an open writer with an earlier timestamp could still commit to key.
 
     Returns:
       A tuple of the matching value and its accompanying write timestamp.
     """
-    if key not in dictionary:
+    bucket = dictionary.get(key)
+    if bucket is None:
       return None
 
-    items = dictionary[key][0]
-    out_item = None
-    for item in items:
-      if item[1] > break_time:
-        break
-      out_item = item
-    dictionary[key][1] = break_time
-    return out_item
+    items = bucket[0]
+    i = self.__split(items, break_time)
+    if track_reads:
+      bucket[1] = break_time
+    if i == 0:
+      return None
+    return items[i - 1]
 
   def __update(self, table, index):
     """Update self's table and index with the values in the passed table and index.
 
     If the read stamp on self's copy of any key from the passed table or index
-    is later than the write stamp of the passed copy the update is aborted.
-    Else, all of the values from the passed table and index are inserted into
-    self's table and index at the matching keys.
+    is later than the write stamp of the passed copy the update is aborted
+    before anything is written.
+    Else, each key's sorted run of values from the passed table and index is
+    merged into the matching bucket of self's table and index.
 
     Args:
       table: The dictionary with which to update self.table
@@ -117,59 +192,67 @@ class TTDBTable(object):
     Raises:
       ConflictingLockException: An exception raised when trying to write to a variable with a later read stamp
     """
-    for k,v in table.items():
-      if k in self.table and self.table[k][1] > v[1]:
-        raise ConflictingLockException
+    for dictionary, updates in ((self.table, table), (self.index, index)):
+      for k, v in updates.iteritems():
+        if k in dictionary and dictionary[k][1] > v[1]:
+          raise ConflictingLockException
 
-    for k,v in index.items():
-      if k in self.index and self.index[k][1] > v[1]:
-        return ConflictingLockException
+    self.apply(table, index)
 
-    for k,v in table.items():
-      for value in v[0]:
-        self.__insert(self.table, k, value)
+  def apply(self, table, index):
+    """Merge a write set into self's table and index without checking read stamps.
 
-    for k,v in index.items():
-      for value in v[0]:
-        self.__insert(self.index, k, value)
+    Used directly to replay a write set that has already been committed to
+    another copy of the table.
 
-  def read_value(self, key, time):
+    Args:
+      table: The dictionary with which to update self.table
+      index: The dictionary with which to update self.index
+    """
+    for dictionary, updates in ((self.table, table), (self.index, index)):
+      for k, v in updates.iteritems():
+        if v[0]:
+          self.__merge(dictionary, k, v[0])
+
+  def read_value(self, key, time, track_reads=True):
     """Read item from database as it existed at the given time.
 
     Args:
       key: The key to read
       time: datetime stamp indicating which snapshot to read
+      track_reads: (keyword) A boolean representing whether to update read timestamps along the way
 
     Returns:
       The matching item from the given time
     """
-    return_pair = self.__read_item(self.table, key, time)
+    return_pair = self.__read_item(self.table, key, time, track_reads)
 
     if return_pair is None:
       if self.parent is None:
         return None
       else:
-        return self.parent.read_value(key, time)
+        return self.parent.read_value(key, time, track_reads)
     else:
       return return_pair[0]
 
-  def read_index(self, value, time):
+  def read_index(self, value, time, track_reads=True):
     """Read item from index as it existed at the given time.
 
     Args:
       key: The key to read
       time: datetime stamp indicating which snapshot to read
+      track_reads: (keyword) A boolean representing whether to update read timestamps along the way
 
     Returns:
       The matching count of matching values from the given time
     """
-    return_pair = self.__read_item(self.index, value, time)
+    return_pair = self.__read_item(self.index, value, time, track_reads)
 
     if return_pair is None:
       if self.parent is None:
         return 0
       else:
-        return self.parent.read_index(value, time)
+        return self.parent.read_index(value, time, track_reads)
     else:
       return return_pair[0]
 
@@ -194,20 +277,31 @@ class TTDBTable(object):
       old_index = self.read_index(value, time)
       self.__insert(self.index, value, (old_index + 1, time))
 
-  def commit(self):
+  def commit(self, table=None, index=None):
     """Commit the database to the parent database.
-    
+
+    Args:
+      table: (keyword) A write set to commit in place of self.table, such as one folded from nested transactions
+      index: (keyword) A write set to commit in place of self.index
+
     Raises:
+      ConflictingLockException: An exception raised when trying to write to a variable with a later read stamp
       NoTransactionException: An exception raised if there is no transaction to commit.
     """
-    if self.parent is not None:
-      return self.parent.__update(self.table, self.index)
-    else:
+    if self.parent is None:
       raise NoTransactionException
+    if table is None:
+      table = self.table
+    if index is None:
+      index = self.index
+    self.parent.__update(table, index)
 
   def purge_entries(self, time):
     """Purge entries from the database older than the indicated time
 
+    For each key only the latest entry at or before time and any later
+    entries are kept, so the database can still be read as of time or later.
+
     Args:
       time: A datetime stamp indicating the latest time to keep
     """
@@ -221,14 +315,7 @@ class TTDBTable(object):
         del self.table[key]
       else:
         values = self.table[key][0]
-	cutoff = time
-	if values[0][1] <= time:
-          cutoff = max([value[1] for value in values if value[1] <= time])
-	out_values = [value for value in values if value[1] >= cutoff]
-	if len(out_values) > 0:
-	  self.table[key][0] = out_values
-	else:
-	  self.table[key][0] = values[-1:]
+        self.table[key][0] = values[max(self.__split(values, time) - 1, 0):]
 
     for key in self.index.keys():
       if len(self.index[key][0]) == 1 and self.index[key][0][0][0] > 0:
@@ -237,14 +324,7 @@ class TTDBTable(object):
         del self.index[key]
       elif len(self.index[key][0]) > 1:
         values = self.index[key][0]
-	cutoff = time
-	if values[0][1] <= time:
-          cutoff = max([value[1] for value in values if value[1] <= time])
-	out_values = [value for value in values if value[1] >= cutoff]
-	if len(out_values) > 0:
-	  self.index[key][0] = out_values
-	else:
-	  self.index[key][0] = values[-1:]
+        self.index[key][0] = values[max(self.__split(values, time) - 1, 0):]
 
     self.purge_stamp = datetime.datetime.now()
 
@@ -265,13 +345,45 @@ class TTDB(object):
     transactions: Dictionary mapping sockets to their open transactions
     ttable: TTDBTable object with the highest-level database
     purge_period: Minimum period at which to purge database of outdated items
+    buffers: Dictionary mapping sockets to received text not yet split into pending commands
+    scanned: Dictionary mapping sockets to how many bytes at the start of their buffer are known to hold no '|'
+    pending: Dictionary mapping sockets to deques of received commands not yet run
+    subscribers: Dictionary mapping keys to sets of sockets subscribed to them
+    prefix_subscribers: Dictionary mapping key prefixes to sets of sockets subscribed to them
+    subscriptions: Dictionary mapping subscribed sockets to sets of their (prefix, key) subscriptions, where prefix is a boolean representing whether key is a key prefix
+    outgoing: Dictionary mapping sockets to responses and messages not yet sent to them
+    subscriber_buffer: Maximum number of bytes of unsent messages a subscriber may have before it is dropped
+    retain: Number of seconds of history to keep for time-travel reads
+    max_connections: Maximum number of client connections; further ones are turned away
+    budget: Maximum number of commands to run from each connection per round of the run loop
+    max_pending: Number of pending commands at which to stop reading from a connection
+    max_depth: Maximum transaction nesting depth
+    high_water: Number of bytes of unsent responses at which to stop reading from and running commands for a connection
+    max_input: Maximum number of bytes of a single unterminated command; a connection sending a longer one is closed
+    throttled: Dictionary mapping sockets to sets of the reasons they are currently throttled
+    closing: Set of sockets whose clients have stopped sending, to be closed once their pending commands have run and their responses are sent
+    broken: Set of sockets that failed to send, whose responses are discarded
+    metrics: Dictionary mapping the names of throttle events to how many times they have happened
+    reader_count: Number of reader processes to serve snapshot reads from
+    readers: List of multiprocessing Connections to the reader processes
+    reader_pids: Dictionary mapping reader Connections to their process ids
+    delegated: Dictionary mapping the file descriptors of sockets handed over to a reader process to tuples of the socket and the reader's Connection
   """
-  def __init__(self, sock_addr='./ttdb_socket', purge_period=20):
+  def __init__(self, sock_addr='./ttdb_socket', purge_period=20, subscriber_buffer=65536, retain=0, max_connections=1000, budget=16, max_pending=64, max_depth=64, high_water=65536, max_input=65536, readers=0):
     """Init TTDB with default Unix socket and purge period
     
     Args:
       sock_addr: Location of Unix socket to use
       purge_period: Minimum period at which to purge database of outdated items
+      subscriber_buffer: Maximum number of bytes of unsent messages a subscriber may have before it is dropped
+      retain: Number of seconds of history to keep for time-travel reads
+      max_connections: Maximum number of client connections; further ones are turned away
+      budget: Maximum number of commands to run from each connection per round of the run loop
+      max_pending: Number of pending commands at which to stop reading from a connection
+      max_depth: Maximum transaction nesting depth
+      high_water: Number of bytes of unsent responses at which to stop reading from and running commands for a connection
+      max_input: Maximum number of bytes of a single unterminated command; a connection sending a longer one is closed
+      readers: Number of reader processes to serve snapshot reads from
 
     Raises:
       OSError: Error raised if the socket already exists but cannot be removed
@@ -283,83 +395,435 @@ class TTDB(object):
         raise
     self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     self.sock.bind(sock_addr)
-    self.sock.listen(5)
+    self.sock.listen(socket.SOMAXCONN)
     self.connections = [self.sock]
 
     self.transactions = {}
     self.purge_period = purge_period
     self.ttable = TTDBTable(purge_period=self.purge_period)
+    self.buffers = {}
+    self.scanned = {}
+    self.pending = {}
+    self.subscribers = {}
+    self.prefix_subscribers = {}
+    self.subscriptions = {}
+    self.outgoing = {}
+    self.subscriber_buffer = subscriber_buffer
+    self.retain = retain
+    self.max_connections = max_connections
+    self.budget = budget
+    self.max_pending = max_pending
+    self.max_depth = max_depth
+    self.high_water = high_water
+    self.max_input = max_input
+    self.throttled = {}
+    self.closing = set()
+    self.broken = set()
+    self.metrics = dict.fromkeys(['connections_rejected', 'budget_exhausted', 'pending_throttled', 'output_throttled', 'nesting_rejected', 'subscribers_dropped', 'input_rejected'], 0)
+    self.reader_count = readers
+    self.readers = []
+    self.reader_pids = {}
+    self.delegated = {}
 
   def run(self):
-    """Run TTDB server on infinite listening loop."""
+    """Run TTDB server on infinite listening loop.
+
+    Each round every connection with pending commands runs at most budget of
+    them, in turn, so one busy connection cannot starve the rest.  A
+    connection is not read from while it has max_pending commands waiting or
+    high_water bytes of responses it has not taken yet.  A connection whose
+    client stops sending is only closed once everything it sent has run and
+    every response has been sent.  A connection that sends more than
+    max_input bytes without ending a command is told so and closed the same
+    way.
+
+    With reader_count readers, connections about to read a snapshot are
+    handed over to reader processes, which run on other cores, and come
+    back when they send anything else.
+    """
+    for i in range(self.reader_count - len(self.readers)):
+      self.spawn_reader()
     while True:
-      rready, wready, xready = select.select(self.connections, [], [], self.purge_period)
+      for s in self.connections[1:]:
+        self.throttle(s, 'pending_throttled', len(self.pending.get(s, ())) >= self.max_pending)
+        self.throttle(s, 'output_throttled', len(self.outgoing[s]) >= self.high_water)
+      listening = [s for s in self.connections if len(self.throttled.get(s, ())) == 0 and s not in self.closing] + self.readers
+      writing = [s for s in self.outgoing if len(self.outgoing[s]) > 0]
+      timeout = self.purge_period
+      if len([1 for s in self.connections[1:] if self.runnable(s)]) > 0:
+        timeout = 0
+      rready, wready, xready = select.select(listening, writing, [], timeout)
+
+      for s in wready:
+        if s in self.outgoing:
+          self.flush(s)
 
       for s in rready:
         if s == self.sock:
-          connection, client_addr = self.sock.accept()
-          self.connections.append(connection)
-          print >>sys.stderr, "New connection: %d" % connection.fileno()
+          self.accept()
+        elif s in self.readers:
+          self.receive(s)
+        elif s not in self.connections:
+          continue
         else:
-          data = s.recv(64)  # I'll have to robustify this in a bit
+          try:
+            data = s.recv(4096)
+          except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+              continue
+            data = ''
           if data:
-            data = data.split('|')
-            for datum in data:
-              if len(datum) == 0:
-                continue
-              datum = datum.split()
-              if datum[0] == 'SET' and len(datum) == 3:
-		try:
-                  self.set(datum[1], datum[2], s)
-		except ReadOnlyException:
-		  s.sendall('Cannot SET in read-only transaction')
-		except ConflictingLockException:
-                  s.sendall('Conflicting lock. Aborting SET.')
-              elif datum[0] == 'GET' and len(datum) == 2:
-                self.get(datum[1], s)
-              elif datum[0] == 'UNSET' and len(datum) == 2:
-		try:
-                  self.unset(datum[1], s)
-		except ReadOnlyException:
-		  s.sendall('Cannot UNSET in read-only transaction')
-		except ConflictingLockException:
-                  s.sendall('Conflicting lock. Aborting UNSET.')
-              elif datum[0] == 'NUMEQUALTO' and len(datum) == 2:
-                self.numequalto(datum[1], s)
-              elif datum[0] == 'BEGIN' and len(datum) == 1:
-                self.begin(s, 'RW')
-              elif datum[0] == 'BEGIN' and len(datum) == 2:
-                self.begin(s, datum[1])
-              elif datum[0] == 'ROLLBACK' and len(datum) == 1:
-                self.rollback(s)
-              elif datum[0] == 'COMMIT' and len(datum) == 1:
-		try:
-                  self.commit(s)
-                  del self.transactions[s]
-		except ConflictingLockException:
-                  connection.sendall('Conflicting lock. Rolling back.')
-                  del self.transactions[s]
-                except NoTransactionException:
-                  connection.sendall('No transaction to commit.')
-              elif datum[0] == 'RESET' and len(datum) == 1:
-                self.ttable = TTDBTable()
-                self.transactions = {}
-		s.sendall('success')
-              elif datum[0] == 'DEBUG' and len(datum) == 1:
-                if s in self.transactions:
-                  self.transactions[s].debug()
-                else:
-                  self.ttable.debug()
-		s.sendall('success')
+            self.buffers[s] = self.buffers.get(s, '') + data
+            self.parse(s)
+            if len(self.buffers[s]) > self.max_input and len(self.pending[s]) < self.max_pending:
+              self.metrics['input_rejected'] += 1
+              self.buffers.pop(s)
+              self.scanned.pop(s, None)
+              self.send(s, 'Command too long')
+              self.closing.add(s)
           else:
-            s.close()
-            self.connections.remove(s)
-            if s in self.transactions:
-              del self.transactions[s]
-            print >>sys.stderr, "Connections: %s" % ",".join([str(i.fileno()) for i in self.connections])
-      self.ttable.purge_entries(min([s.timestamp for s in self.transactions.values()] + [datetime.datetime.now()]))
-
-  def begin(self, connection, transaction_type):
+            self.closing.add(s)
+
+      self.schedule()
+      for s in list(self.closing):
+        if len(self.pending.get(s, ())) == 0 and len(self.outgoing[s]) == 0:
+          self.close(s)
+      self.ttable.purge_entries(self.purge_time())
+
+  def accept(self):
+    """Accept a new connection, or turn it away if there are already max_connections."""
+    connection, client_addr = self.sock.accept()
+    if len(self.connections) - 1 + len(self.delegated) >= self.max_connections:
+      self.metrics['connections_rejected'] += 1
+      try:
+        connection.send('Too many connections')
+      except socket.error:
+        pass
+      connection.close()
+      return
+    connection.setblocking(0)
+    self.connections.append(connection)
+    self.outgoing[connection] = ''
+    print >>sys.stderr, "New connection: %d" % connection.fileno()
+
+  def throttle(self, connection, reason, throttled):
+    """Record whether a connection is throttled for the given reason.
+
+    Counts an event in metrics each time the connection becomes throttled.
+
+    Args:
+      connection: The socket connection to update
+      reason: A string naming the throttle, also its key in metrics
+      throttled: A boolean representing whether the connection is now throttled for reason
+    """
+    reasons = self.throttled.setdefault(connection, set())
+    if throttled and reason not in reasons:
+      reasons.add(reason)
+      self.metrics[reason] += 1
+    elif not throttled:
+      reasons.discard(reason)
+
+  def runnable(self, connection):
+    """Check whether a connection has a command that can run now.
+
+    Args:
+      connection: The socket connection to check
+
+    Returns:
+      True if connection is open, has pending commands and is below the response high-water mark
+    """
+    return (connection in self.connections and len(self.pending.get(connection, ())) > 0 and
+            len(self.outgoing[connection]) < self.high_water)
+
+  def parse(self, connection):
+    """Move complete commands from the connection's buffer to its pending commands.
+
+    Stops once the connection has max_pending commands, leaving the rest of
+    the text in the buffer for later.  Only text not already searched for a
+    '|' is searched, so a long unterminated command costs O(len) in total
+    rather than O(len) on every recv.
+
+    Args:
+      connection: The socket connection whose buffer to parse
+    """
+    if connection not in self.connections:
+      return
+    pending = self.pending.setdefault(connection, collections.deque())
+    buf = self.buffers.get(connection, '')
+    start = 0
+    scan = self.scanned.get(connection, 0)
+    while len(pending) < self.max_pending:
+      end = buf.find('|', scan)
+      if end < 0:
+        scan = len(buf)
+        break
+      datum = buf[start:end].split()
+      start = scan = end + 1
+      if len(datum) > 0:
+        pending.append(datum)
+    if start > 0:
+      self.buffers[connection] = buf[start:]
+    self.scanned[connection] = scan - start
+
+  def schedule(self):
+    """Run one round of pending commands, at most budget from each connection in turn."""
+    for connection in self.connections[1:]:
+      ran = 0
+      while ran < self.budget and self.runnable(connection):
+        if self.delegate(connection):
+          break
+        self.execute(self.pending[connection].popleft(), connection)
+        ran += 1
+      self.parse(connection)
+      if ran == self.budget and self.runnable(connection):
+        self.metrics['budget_exhausted'] += 1
+
+  def close(self, connection):
+    """Close a connection and forget everything associated with it.
+
+    Args:
+      connection: The socket connection to close
+    """
+    connection.close()
+    self.forget(connection)
+    print >>sys.stderr, "Connections: %s" % ",".join([str(i.fileno()) for i in self.connections])
+
+  def forget(self, connection):
+    """Forget everything associated with a connection without closing it.
+
+    Args:
+      connection: The socket connection to forget
+    """
+    self.connections.remove(connection)
+    if connection in self.transactions:
+      del self.transactions[connection]
+    self.buffers.pop(connection, None)
+    self.scanned.pop(connection, None)
+    self.pending.pop(connection, None)
+    self.unsubscribe([], connection)
+    self.outgoing.pop(connection, None)
+    self.throttled.pop(connection, None)
+    self.closing.discard(connection)
+    self.broken.discard(connection)
+
+  def unparsed(self, connection):
+    """Rebuild the text of the commands a connection has sent but not run yet.
+
+    Args:
+      connection: The socket connection whose commands to rebuild
+
+    Returns:
+      A string of the pending commands followed by the text not yet split into commands
+    """
+    return ''.join([' '.join(datum) + ' |' for datum in self.pending.get(connection, ())]) + self.buffers.get(connection, '')
+
+  def spawn_reader(self):
+    """Fork a reader process.
+
+    The reader starts from a copy-on-write copy of the table as it is now,
+    the latest published snapshot, and is kept up to date with every write
+    committed after that.
+    """
+    reader, channel = multiprocessing.Pipe()
+    sys.stdout.flush()
+    pid = os.fork()
+    if pid == 0:
+      try:
+        reader.close()
+        for connection in self.readers + self.connections + [s for s, r in self.delegated.values()]:
+          connection.close()
+        TTDBReader(self, channel).run()
+      except Exception:
+        traceback.print_exc()
+      finally:
+        os._exit(1)
+    channel.close()
+    self.readers.append(reader)
+    self.reader_pids[reader] = pid
+    print >>sys.stderr, "New reader: %d" % pid
+
+  def lose_reader(self, reader):
+    """Close the connections of a reader process that has exited and fork a replacement.
+
+    Args:
+      reader: Connection to the exited reader
+    """
+    self.readers.remove(reader)
+    pid = self.reader_pids.pop(reader)
+    os.waitpid(pid, 0)
+    reader.close()
+    for fd, (connection, owner) in self.delegated.items():
+      if owner is reader:
+        del self.delegated[fd]
+        connection.close()
+    print >>sys.stderr, "Lost reader: %d" % pid
+    self.spawn_reader()
+
+  def tell(self, reader, *message):
+    """Send a message to a reader process along with the latest snapshot time it may read.
+
+    Args:
+      reader: Connection to the reader
+      message: The kind of message followed by its arguments
+    """
+    reader.send((message[0], self.snapshot_time(datetime.datetime.now())) + message[1:])
+
+  def replicate(self, *message):
+    """Send a change to the table to every reader process.
+
+    Args:
+      message: The kind of change followed by its arguments
+    """
+    for reader in self.readers:
+      self.tell(reader, *message)
+
+  def delegate(self, connection):
+    """Hand a connection over to a reader process if its next command only reads a snapshot.
+
+    Connections in a transaction or in subscribe mode, or with responses
+    still to send, stay put.  The connection goes to the reader with the
+    fewest connections, along with all the text it has sent but not run.
+
+    Args:
+      connection: The socket connection to hand over
+
+    Returns:
+      True if the connection was handed over
+    """
+    if (len(self.readers) == 0 or connection in self.transactions or connection in self.subscriptions or
+        connection in self.broken or len(self.outgoing[connection]) > 0 or
+        not snapshot_read(self.pending[connection][0])):
+      return False
+    loads = dict([(reader, 0) for reader in self.readers])
+    for s, reader in self.delegated.values():
+      loads[reader] += 1
+    reader = min(self.readers, key=lambda reader: loads[reader])
+    text = self.unparsed(connection)
+    self.forget(connection)
+    self.delegated[connection.fileno()] = (connection, reader)
+    self.tell(reader, 'connection', connection.fileno(), text)
+    reduction.send_handle(reader, connection.fileno(), self.reader_pids[reader])
+    return True
+
+  def receive(self, reader):
+    """Handle the messages waiting from a reader process.
+
+    Args:
+      reader: Connection to the reader
+    """
+    while reader in self.readers and reader.poll():
+      try:
+        message = reader.recv()
+      except (EOFError, IOError):
+        self.lose_reader(reader)
+        return
+      if message[0] == 'connection':
+        connection = self.delegated.pop(message[1])[0]
+        self.connections.append(connection)
+        self.outgoing[connection] = ''
+        self.buffers[connection] = message[2]
+        self.parse(connection)
+      elif message[0] == 'closed':
+        self.delegated.pop(message[1])[0].close()
+        print >>sys.stderr, "Connections: %s" % ",".join([str(i.fileno()) for i in self.connections])
+      elif message[0] == 'stats':
+        self.tell(reader, 'stats', message[1], self.statistics(*message[2]))
+      elif message[0] == 'metrics':
+        for name, count in message[1].iteritems():
+          self.metrics[name] += count
+
+  def execute(self, datum, s):
+    """Run a single command and send its response.
+
+    Args:
+      datum: A list of the words of the command
+      s: The socket connection that sent the command
+    """
+    if datum[0] in ('SUBSCRIBE', 'PSUBSCRIBE') and len(datum) > 1:
+      try:
+        self.subscribe(datum[1:], s, prefix=datum[0] == 'PSUBSCRIBE')
+      except InvalidSubscriptionException as e:
+        if s in self.subscriptions:
+          self.push(s, str(e))
+        else:
+          self.send(s, str(e))
+    elif datum[0] == 'UNSUBSCRIBE':
+      self.unsubscribe(datum[1:], s)
+    elif s in self.subscriptions:
+      self.push(s, 'Only SUBSCRIBE, PSUBSCRIBE and UNSUBSCRIBE allowed while subscribed')
+    elif datum[0] == 'SET' and len(datum) == 3:
+      try:
+        self.set(datum[1], datum[2], s)
+      except ReadOnlyException:
+        self.send(s, 'Cannot SET in read-only transaction')
+      except ConflictingLockException:
+        self.send(s, 'Conflicting lock. Aborting SET.')
+    elif datum[0] == 'GET' and len(datum) == 2:
+      self.get(datum[1], s)
+    elif datum[0] == 'GET' and len(datum) == 4 and datum[2] == 'AT':
+      try:
+        self.get(datum[1], s, parse_timestamp(datum[3]))
+      except InvalidTimestampException as e:
+        self.send(s, str(e))
+    elif datum[0] == 'UNSET' and len(datum) == 2:
+      try:
+        self.unset(datum[1], s)
+      except ReadOnlyException:
+        self.send(s, 'Cannot UNSET in read-only transaction')
+      except ConflictingLockException:
+        self.send(s, 'Conflicting lock. Aborting UNSET.')
+    elif datum[0] == 'NUMEQUALTO' and len(datum) == 2:
+      self.numequalto(datum[1], s)
+    elif datum[0] == 'NUMEQUALTO' and len(datum) == 4 and datum[2] == 'AT':
+      try:
+        self.numequalto(datum[1], s, parse_timestamp(datum[3]))
+      except InvalidTimestampException as e:
+        self.send(s, str(e))
+    elif datum[0] == 'BEGIN' and (len(datum) <= 2 or (len(datum) == 4 and datum[2] == 'AT')):
+      try:
+        if len(datum) == 1:
+          self.begin(s, 'RW')
+        elif len(datum) == 2:
+          self.begin(s, datum[1])
+        else:
+          self.begin(s, datum[1], parse_timestamp(datum[3]))
+      except InvalidTimestampException as e:
+        self.send(s, str(e))
+      except NestingTooDeepException:
+        self.metrics['nesting_rejected'] += 1
+        self.send(s, 'Transaction nesting too deep')
+    elif datum[0] == 'ROLLBACK' and len(datum) == 1:
+      self.rollback(s)
+    elif datum[0] == 'COMMIT' and len(datum) == 1:
+      try:
+        self.commit(s)
+      except ConflictingLockException:
+        self.send(s, 'Conflicting lock. Rolling back.')
+      except NoTransactionException:
+        self.send(s, 'No transaction to commit.')
+    elif datum[0] == 'EXEC' and len(datum) > 1:
+      try:
+        self.execute_batch(parse_batch(datum[1:]), s)
+      except ConflictingLockException:
+        self.send(s, 'Conflicting lock. Aborting EXEC.')
+      except InvalidBatchException as e:
+        self.send(s, str(e))
+    elif datum[0] == 'STATS' and len(datum) <= 2:
+      self.stats(s, *datum[1:])
+    elif datum[0] == 'RESET' and len(datum) == 1:
+      self.ttable = TTDBTable()
+      self.transactions = {}
+      self.metrics = dict.fromkeys(self.metrics, 0)
+      self.replicate('reset')
+      self.send(s, 'success')
+    elif datum[0] == 'DEBUG' and len(datum) == 1:
+      if s in self.transactions:
+        self.transactions[s].debug()
+      else:
+        self.ttable.debug()
+      self.send(s, 'success')
+
+  def begin(self, connection, transaction_type, at=None):
     """Open a new transaction and associate it with the connection.
 
     If the connection already has a transaction, this will nest a new one in it.
@@ -367,18 +831,110 @@ class TTDB(object):
     Args:
       connection: The socket connection calling the 'begin'
       transaction_type: A string containing the transaction type: RW (read-write) or RO (read-only)
+      at: Optional datetime stamp of the past snapshot a new read-only transaction should read
+
+    Raises:
+      InvalidTimestampException: An exception raised when at is given for a nested or read-write transaction, or is outside the retention window
+      NestingTooDeepException: An exception raised when the transaction is already nested max_depth deep
     """
     if connection in self.transactions:
+      if at is not None:
+        raise InvalidTimestampException('Cannot BEGIN AT in a transaction')
+      if self.transactions[connection].depth() >= self.max_depth:
+        raise NestingTooDeepException
       self.transactions[connection].begin()
     else:
-      self.transactions[connection] = TTDBTransaction(self.ttable, transaction_type)
-    connection.sendall('success')
+      self.transactions[connection] = self.new_transaction(transaction_type, at)
+    self.send(connection, 'success')
+
+  def new_transaction(self, transaction_type, at=None):
+    """Create a new top-level transaction on the main table.
+
+    A read-only transaction reads from the latest immutable snapshot, or the
+    one at the given time, and never updates read stamps.  A read-write
+    transaction only updates read stamps if an earlier read-write transaction
+    is open and could still commit.
+
+    Args:
+      transaction_type: A string containing the transaction type: RW (read-write) or RO (read-only)
+      at: Optional datetime stamp of the past snapshot a read-only transaction should read
+
+    Returns:
+      The new TTDBTransaction
+
+    Raises:
+      InvalidTimestampException: An exception raised when at is given for a read-write transaction or is outside the retention window
+    """
+    if transaction_type == 'RW':
+      if at is not None:
+        raise InvalidTimestampException('Cannot BEGIN RW AT a timestamp')
+      track_reads = len([1 for transaction in self.transactions.values() if transaction.writeable()]) > 0
+      return TTDBTransaction(self.ttable, transaction_type, track_reads=track_reads)
+    elif at is not None:
+      return TTDBTransaction(self.ttable, transaction_type, self.history_time(at), track_reads=False)
+    else:
+      timestamp = self.snapshot_time(datetime.datetime.now())
+      return TTDBTransaction(self.ttable, transaction_type, timestamp, track_reads=False)
+
+  def retain_time(self):
+    """Find the earliest time whose history must be kept for time-travel reads.
+
+    Returns:
+      A datetime stamp retain seconds before now
+    """
+    return datetime.datetime.now() - datetime.timedelta(seconds=self.retain)
+
+  def purge_time(self):
+    """Find the latest time whose history can be purged.
+
+    Returns:
+      A datetime stamp no later than any open transaction's or the retention window's start
+    """
+    return min([transaction.timestamp for transaction in self.transactions.values()] + [self.retain_time()])
+
+  def history_time(self, time):
+    """Check a time-travel read's timestamp and find the snapshot to read.
+
+    Times later than the latest immutable snapshot read that snapshot instead.
+
+    Args:
+      time: datetime stamp requested by the client
+
+    Returns:
+      A datetime stamp of the snapshot to read
+
+    Raises:
+      InvalidTimestampException: An exception raised when time is outside the retention window
+    """
+    if time < self.retain_time():
+      raise InvalidTimestampException('Timestamp outside retention window')
+    return min(time, self.snapshot_time(datetime.datetime.now()))
+
+  def snapshot_time(self, time):
+    """Find the latest time no later than the given time that is safe to read without read stamps.
+
+    Only the earliest open read-write transaction may commit, and nothing
+    else may write while it is open, so the table as of just before its
+    timestamp can no longer change.  Reading at that time needs no read
+    stamps and cannot abort any writer.
+
+    Args:
+      time: datetime stamp indicating the desired snapshot
+
+    Returns:
+      time if no open read-write transaction started at or before it, else a datetime stamp just before the earliest such transaction
+    """
+    writers = [transaction.timestamp for transaction in self.transactions.values() if transaction.writeable()]
+    if len(writers) > 0 and min(writers) <= time:
+      return min(writers) - datetime.timedelta(microseconds=1)
+    return time
 
   def commit(self, connection):
     """Commit the open transaction, collapsing nested transactions if they exist.
 
     If this transaction is not the earliest existing, abort.  The earliest
-    transaction has an implicit write lock to preserve consistency.
+    transaction has an implicit write lock to preserve consistency.  Either
+    way the transaction is closed.
 
     Sends a message to connection to indicate success or failure.
 
@@ -392,11 +948,15 @@ class TTDB(object):
     if connection not in self.transactions:
       raise NoTransactionException
 
-    if self.transactions[connection].writeable() and self.transactions[connection].timestamp > min([X.timestamp for X in self.transactions.values() if X.writeable()]):
+    transaction = self.transactions.pop(connection)
+    if transaction.writeable() and transaction.timestamp > min([X.timestamp for X in self.transactions.values() if X.writeable()] + [transaction.timestamp]):
       raise ConflictingLockException
     else:
-      self.transactions[connection].commit()
-      connection.sendall('success')
+      table, index = transaction.commit()
+      self.notify(table)
+      if transaction.writeable():
+        self.replicate('commit', table, index)
+      self.send(connection, 'success')
 
   def rollback(self, connection):
     """Rollback the open transaction, collapsing nested transactions if they exist.
@@ -408,9 +968,246 @@ class TTDB(object):
     if connection in self.transactions:
       if self.transactions[connection].rollback() is None:
         del self.transactions[connection]
-      connection.sendall('success')
+      self.send(connection, 'success')
+    else:
+      self.send(connection, 'INVALID ROLLBACK')
+
+  def execute_batch(self, commands, connection):
+    """Run a batch of commands atomically as a single transaction.
+
+    The whole batch runs from begin to commit without returning to the run
+    loop, so no other command can interleave with it and any write lock is
+    held only for as long as the batch takes to run.  A batch with no writes
+    runs as a read-only transaction.
+
+    Sends a single message to connection with the result of each command,
+    one per line.
+
+    Args:
+      commands: A list of commands, each a list of words
+      connection: The socket connection calling the 'exec'
+
+    Raises:
+      ConflictingLockException: An exception raised when trying to write while a transaction has write priority
+      InvalidBatchException: An exception raised when the batch is empty, contains anything but SET, UNSET, GET and NUMEQUALTO, or is sent inside a transaction
+    """
+    if connection in self.transactions:
+      raise InvalidBatchException('Cannot EXEC in a transaction')
+    if len(commands) == 0:
+      raise InvalidBatchException('Empty EXEC batch')
+    transaction_type = 'RO'
+    for command in commands:
+      if (command[0] == 'SET' and len(command) == 3) or (command[0] == 'UNSET' and len(command) == 2):
+        transaction_type = 'RW'
+      elif command[0] not in ('GET', 'NUMEQUALTO') or len(command) != 2:
+        raise InvalidBatchException('Invalid command in EXEC: %s' % ' '.join(command))
+    if transaction_type == 'RW' and len([1 for transaction in self.transactions.values() if transaction.writeable()]) > 0:
+      raise ConflictingLockException
+
+    transaction = self.new_transaction(transaction_type)
+    results = []
+    for command in commands:
+      if command[0] == 'SET':
+        transaction.set(command[1], command[2])
+        results.append('success')
+      elif command[0] == 'UNSET':
+        transaction.unset(command[1])
+        results.append('success')
+      elif command[0] == 'GET':
+        results.append(format_response(transaction.get(command[1])))
+      elif command[0] == 'NUMEQUALTO':
+        results.append(format_response(transaction.numequalto(command[1])))
+    table, index = transaction.commit()
+    self.notify(table)
+    if transaction.writeable():
+      self.replicate('commit', table, index)
+    self.send(connection, '\n'.join(results))
+
+  def subscribe(self, patterns, connection, prefix=False):
+    """Subscribe connection to changes committed to the given keys or key prefixes.
+
+    The connection switches to subscribe mode for good: from then on only
+    SUBSCRIBE, PSUBSCRIBE and UNSUBSCRIBE are accepted and every message to
+    it, including each committed change, is a line of its own.  Changes are
+    sent as "key value" lines.
+
+    Sends a message to connection to indicate success or failure.
+
+    Args:
+      patterns: A list of keys, or of key prefixes each followed by '*'
+      connection: The socket connection calling the 'subscribe'
+      prefix: (keyword) A boolean representing whether patterns are key prefixes
+
+    Raises:
+      InvalidSubscriptionException: An exception raised when subscribing inside a transaction or to a prefix pattern not ending in '*'
+    """
+    if connection in self.transactions:
+      raise InvalidSubscriptionException('Cannot SUBSCRIBE in a transaction')
+    if prefix:
+      for pattern in patterns:
+        if not pattern.endswith('*'):
+          raise InvalidSubscriptionException('Invalid prefix pattern: %s' % pattern)
+
+    if connection not in self.subscriptions:
+      self.subscriptions[connection] = set()
+    for pattern in patterns:
+      if prefix:
+        self.prefix_subscribers.setdefault(pattern[:-1], set()).add(connection)
+        self.subscriptions[connection].add((True, pattern[:-1]))
+      else:
+        self.subscribers.setdefault(pattern, set()).add(connection)
+        self.subscriptions[connection].add((False, pattern))
+    self.push(connection, 'success')
+
+  def unsubscribe(self, patterns, connection):
+    """Unsubscribe connection from the given keys or key prefixes.
+
+    A pattern ending in '*' drops the matching PSUBSCRIBE prefix as well as
+    any SUBSCRIBE to that exact key.  The connection stays in subscribe mode
+    even with no subscriptions left.
+
+    Args:
+      patterns: A list of patterns as given to SUBSCRIBE or PSUBSCRIBE, or an empty list to unsubscribe from everything
+      connection: The socket connection calling the 'unsubscribe'
+    """
+    if connection not in self.subscriptions:
+      if connection in self.connections:
+        self.send(connection, 'Not subscribed')
+      return
+    if len(patterns) == 0:
+      subscriptions = list(self.subscriptions[connection])
+    else:
+      subscriptions = [(False, pattern) for pattern in patterns] + [(True, pattern[:-1]) for pattern in patterns if pattern.endswith('*')]
+    for subscription in subscriptions:
+      if subscription not in self.subscriptions[connection]:
+        continue
+      self.subscriptions[connection].remove(subscription)
+      prefix, key = subscription
+      index = self.prefix_subscribers if prefix else self.subscribers
+      index[key].discard(connection)
+      if len(index[key]) == 0:
+        del index[key]
+    if connection in self.connections:
+      self.push(connection, 'success')
+    else:
+      del self.subscriptions[connection]
+
+  def notify(self, table):
+    """Push every change in a committed write set to its subscribers.
+
+    Args:
+      table: The table write set that was committed
+    """
+    if len(self.subscribers) == 0 and len(self.prefix_subscribers) == 0:
+      return
+    for key, bucket in table.iteritems():
+      if len(bucket[0]) > 0:
+        self.publish(key, bucket[0][-1][0])
+
+  def publish(self, key, value):
+    """Push a committed change to the connections subscribed to key.
+
+    Looks up key itself and each of its prefixes, so the cost depends on the
+    length of key and the number of matching subscribers, not on the number
+    of connections.
+
+    Args:
+      key: The key that changed
+      value: The new value of key, or None if it was unset
+    """
+    if len(self.subscribers) == 0 and len(self.prefix_subscribers) == 0:
+      return
+    targets = set(self.subscribers.get(key, ()))
+    for i in range(len(key) + 1):
+      targets.update(self.prefix_subscribers.get(key[:i], ()))
+    message = '%s %s' % (key, format_response(value))
+    for connection in targets:
+      self.push(connection, message)
+
+  def push(self, connection, message):
+    """Buffer a message for a subscribed connection.
+
+    If the connection's unsent messages would grow past subscriber_buffer the
+    connection is dropped instead, so a slow subscriber can never stall the
+    run loop.
+
+    Args:
+      connection: The subscribed socket connection
+      message: A string containing the message to send
+    """
+    if connection in self.broken:
+      return
+    outgoing = self.outgoing[connection] + message + '\n'
+    if len(outgoing) > self.subscriber_buffer:
+      print >>sys.stderr, "Dropping slow subscriber: %d" % connection.fileno()
+      self.metrics['subscribers_dropped'] += 1
+      self.close(connection)
+    else:
+      self.outgoing[connection] = outgoing
+
+  def send(self, connection, message):
+    """Queue a response for connection and send as much of it as it will take now.
+
+    Whatever the connection does not take stays in outgoing until select
+    reports it writable, so a client that stops reading never blocks the run
+    loop.
+
+    Args:
+      connection: The socket connection to respond to
+      message: A string containing the response
+    """
+    if connection in self.broken:
+      return
+    self.outgoing[connection] += message
+    self.flush(connection)
+
+  def flush(self, connection):
+    """Send as much of a connection's buffered responses and messages as it will take.
+
+    If the connection is broken its responses are discarded from then on and
+    it is closed once the commands it already sent have run.
+
+    Args:
+      connection: The socket connection to flush
+    """
+    try:
+      sent = connection.send(self.outgoing[connection])
+    except socket.error as e:
+      if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+        self.outgoing[connection] = ''
+        self.broken.add(connection)
+        self.closing.add(connection)
+      return
+    self.outgoing[connection] = self.outgoing[connection][sent:]
+
+  def stats(self, connection, name=None):
+    """Send the throttle metrics, one "name count" line each, plus current connection and pending command counts.
+
+    Args:
+      connection: The socket connection calling the 'stats'
+      name: Optional name of the single count to send
+    """
+    self.send(connection, self.statistics(name))
+
+  def statistics(self, name=None):
+    """Format the throttle metrics and current counts for STATS.
+
+    Args:
+      name: Optional name of the single count to format
+
+    Returns:
+      A string with one "name count" line per count, or only the named count
+    """
+    stats = dict(self.metrics)
+    stats['connections'] = len(self.connections) - 1 + len(self.delegated)
+    stats['reader_connections'] = len(self.delegated)
+    stats['pending_commands'] = sum([len(commands) for commands in self.pending.values()])
+    if name is None:
+      return '\n'.join(['%s %d' % (name, stats[name]) for name in sorted(stats)])
+    elif name in stats:
+      return str(stats[name])
     else:
-      connection.sendall('INVALID ROLLBACK')
+      return 'Unknown metric: %s' % name
 
   def set(self, variable, value, connection):
     """Set variable to given the value
@@ -436,30 +1233,37 @@ class TTDB(object):
     elif len([1 for transaction in self.transactions.values() if transaction.writeable()]) > 0:
       raise ConflictingLockException
     else:
-      self.ttable.write_value(variable, value, datetime.datetime.now())
-    connection.sendall('success')
+      stamp = datetime.datetime.now()
+      self.ttable.write_value(variable, value, stamp)
+      self.publish(variable, value)
+      self.replicate('write', variable, value, stamp)
+    self.send(connection, 'success')
 
-  def get(self, variable, connection):
+  def get(self, variable, connection, at=None):
     """Get current value of variable
 
-    If connection has an open transaction, the get falls through to it.
-    Else get value from the main database
+    If at is given get value from the main database as it was at that time.
+    Else if connection has an open transaction, the get falls through to it.
+    Else get value from the latest immutable snapshot of the main database
 
     Sends a message to connection to indicate returned value
 
     Args:
       variable: A string containing the variable to get
       connection: The socket connection calling the 'get'
+      at: Optional datetime stamp of the past snapshot to read
+
+    Raises:
+      InvalidTimestampException: An exception raised when at is outside the retention window
     """
-    value = None
-    if connection in self.transactions:
+    if at is not None:
+      value = self.ttable.read_value(variable, self.history_time(at), track_reads=False)
+    elif connection in self.transactions:
       value = self.transactions[connection].get(variable)
     else:
-      value = self.ttable.read_value(variable, datetime.datetime.now())
+      value = self.ttable.read_value(variable, self.snapshot_time(datetime.datetime.now()), track_reads=False)
 
-    if value is None:
-      value = 'NULL'
-    connection.sendall(str(value))
+    self.send(connection, format_response(value))
 
   def unset(self, variable, connection):
     """Unset given variable
@@ -484,27 +1288,233 @@ class TTDB(object):
     elif len([1 for transaction in self.transactions.values() if transaction.writeable()]) > 0:
       raise ConflictingLockException
     else:
-      self.ttable.write_value(variable, None, datetime.datetime.now())
-    connection.sendall('success')
+      stamp = datetime.datetime.now()
+      self.ttable.write_value(variable, None, stamp)
+      self.publish(variable, None)
+      self.replicate('write', variable, None, stamp)
+    self.send(connection, 'success')
 
-  def numequalto(self, value, connection):
+  def numequalto(self, value, connection, at=None):
     """Get number of variables equal to value
 
-    If connection has an open transaction, the numequalto falls through to it.
-    Else get count from the main database
+    If at is given get count from the main database as it was at that time.
+    Else if connection has an open transaction, the numequalto falls through to it.
+    Else get count from the latest immutable snapshot of the main database
 
     Sends a message to connection to indicate returned count
 
     Args:
       value: A string containing the value to count
       connection: The socket connection calling the 'numequalto'
+      at: Optional datetime stamp of the past snapshot to read
+
+    Raises:
+      InvalidTimestampException: An exception raised when at is outside the retention window
     """
-    if connection in self.transactions:
+    if at is not None:
+      num = self.ttable.read_index(value, self.history_time(at), track_reads=False)
+    elif connection in self.transactions:
       num = self.transactions[connection].numequalto(value)
     else:
-      num = self.ttable.read_index(value, datetime.datetime.now())
+      num = self.ttable.read_index(value, self.snapshot_time(datetime.datetime.now()), track_reads=False)
+
+    self.send(connection, format_response(num))
+
+
+class TTDBReader(TTDB):
+  """A forked process serving snapshot reads for connections handed over by the main TTDB process.
+
+  The reader runs the same loop as the main process over its own copy of the
+  table, which the main process keeps up to date with every committed write.
+  Reads, read-only transactions and time-travel reads are served here; any
+  other command sends the connection back to the main process once its
+  responses so far have been sent.
+
+  Attributes:
+    safe_time: datetime stamp of the latest snapshot the main process has published
+    ids: Dictionary mapping sockets to their file descriptors in the main process
+    returning: Set of sockets to hand back to the main process once their responses are sent
+    waiting: Set of sockets waiting for the main process to answer a STATS
+  """
+  def __init__(self, db, channel):
+    """Init TTDBReader from a forked copy of the main TTDB.
+
+    Args:
+      db: The main process's TTDB, whose table becomes the reader's snapshot
+      channel: multiprocessing Connection to the main process
+    """
+    self.sock = channel
+    self.connections = [channel]
+    self.safe_time = db.snapshot_time(datetime.datetime.now())
+    self.ttable = db.ttable
+    self.purge_period = db.purge_period
+    self.subscriber_buffer = db.subscriber_buffer
+    self.retain = db.retain
+    self.max_connections = db.max_connections
+    self.budget = db.budget
+    self.max_pending = db.max_pending
+    self.max_depth = db.max_depth
+    self.high_water = db.high_water
+    self.max_input = db.max_input
+    self.transactions = {}
+    self.buffers = {}
+    self.scanned = {}
+    self.pending = {}
+    self.subscribers = {}
+    self.prefix_subscribers = {}
+    self.subscriptions = {}
+    self.outgoing = {}
+    self.throttled = {}
+    self.closing = set()
+    self.broken = set()
+    self.metrics = dict.fromkeys(db.metrics, 0)
+    self.reader_count = 0
+    self.readers = []
+    self.reader_pids = {}
+    self.delegated = {}
+    self.ids = {}
+    self.returning = set()
+    self.waiting = set()
+
+  def accept(self):
+    """Handle the messages waiting from the main process.
+
+    Exits the process once the main process has gone.
+    """
+    while self.sock.poll():
+      try:
+        message = self.sock.recv()
+      except (EOFError, IOError):
+        os._exit(0)
+      self.safe_time = message[1]
+      if message[0] == 'write':
+        self.ttable.write_value(message[2], message[3], message[4])
+      elif message[0] == 'commit':
+        self.ttable.apply(message[2], message[3])
+      elif message[0] == 'reset':
+        self.ttable = TTDBTable()
+        self.transactions = {}
+      elif message[0] == 'connection':
+        fd = reduction.recv_handle(self.sock)
+        connection = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM)
+        os.close(fd)
+        connection.setblocking(0)
+        self.connections.append(connection)
+        self.outgoing[connection] = ''
+        self.ids[connection] = message[2]
+        self.buffers[connection] = message[3]
+        self.parse(connection)
+      elif message[0] == 'stats':
+        for connection, fd in self.ids.items():
+          if fd == message[2] and connection in self.waiting:
+            self.waiting.discard(connection)
+            self.pending[connection].popleft()
+            self.send(connection, message[3])
+
+  def runnable(self, connection):
+    """Check whether a connection has a command that can run now.
+
+    Args:
+      connection: The socket connection to check
+
+    Returns:
+      True if connection is open, has pending commands, is below the response high-water mark and is neither going back to the main process nor waiting for it
+    """
+    return (TTDB.runnable(self, connection) and connection not in self.returning and
+            connection not in self.waiting)
+
+  def schedule(self):
+    """Run one round of pending commands against the latest published snapshot.
+
+    Afterwards hands back the connections whose responses have all been
+    sent and reports the round's throttle events to the main process.
+    """
+    self.accept()
+    TTDB.schedule(self)
+    for connection in list(self.returning):
+      if len(self.outgoing[connection]) == 0:
+        text = self.unparsed(connection)
+        fd = self.ids.pop(connection)
+        self.forget(connection)
+        connection.close()
+        self.sock.send(('connection', fd, text))
+    self.report()
+
+  def report(self):
+    """Send the throttle events counted since the last report to the main process."""
+    counts = dict([(name, count) for name, count in self.metrics.iteritems() if count > 0])
+    if len(counts) > 0:
+      self.sock.send(('metrics', counts))
+      self.metrics = dict.fromkeys(self.metrics, 0)
+
+  def forget(self, connection):
+    """Forget everything associated with a connection without closing it.
+
+    Args:
+      connection: The socket connection to forget
+    """
+    TTDB.forget(self, connection)
+    self.returning.discard(connection)
+    self.waiting.discard(connection)
+
+  def close(self, connection):
+    """Close a connection and tell the main process it is gone.
+
+    Args:
+      connection: The socket connection to close
+    """
+    fd = self.ids.pop(connection)
+    connection.close()
+    self.forget(connection)
+    self.sock.send(('closed', fd))
+
+  def execute(self, datum, s):
+    """Run a single command if it can be served here and send its response.
+
+    Outside a transaction only snapshot reads run here.  In a read-only
+    transaction everything but STATS, which the main process answers, and
+    RESET runs here.  Any other command goes back to the main process with
+    the connection.
+
+    Args:
+      datum: A list of the words of the command
+      s: The socket connection that sent the command
+    """
+    if s in self.transactions and datum[0] == 'STATS' and len(datum) <= 2:
+      self.report()
+      self.pending[s].appendleft(datum)
+      self.waiting.add(s)
+      self.sock.send(('stats', self.ids[s], datum[1:]))
+    elif (s in self.transactions and datum[0] != 'RESET') or snapshot_read(datum):
+      TTDB.execute(self, datum, s)
+    else:
+      self.pending[s].appendleft(datum)
+      self.returning.add(s)
+
+  def snapshot_time(self, time):
+    """Find the latest time no later than the given time that is safe to read without read stamps.
 
-    connection.sendall(str(num))
+    Only writes the main process has already published can be read, so this
+    is never later than the snapshot it last published.
+
+    Args:
+      time: datetime stamp indicating the desired snapshot
+
+    Returns:
+      The earlier of time and safe_time
+    """
+    return min(time, self.safe_time)
+
+  def purge_time(self):
+    """Find the latest time whose history can be purged.
+
+    Writes still to be published may be stamped as early as just after
+    safe_time, so no history after it is purged.
+
+    Returns:
+      A datetime stamp no later than any open transaction's, the retention window's start or safe_time
+    """
+    return min(TTDB.purge_time(self), self.safe_time)
 
 
 class TTDBTransaction(object):
@@ -515,14 +1525,16 @@ class TTDBTransaction(object):
     timestamp: datetime stamp indicating time at which the transaction was created and at which it acts
     type: A string containing the transaction type: RW (read-write) or RO (read-only)
     subtransaction: TTDBTransaction object indicating the next level of transaction nesting
+    track_reads: A boolean representing whether reads update read stamps
   """
-  def __init__(self, parent, transaction_type, timestamp=None):
+  def __init__(self, parent, transaction_type, timestamp=None, track_reads=True):
     """Init TTDBTransaction with given parent, a timestamp, and no subtransaction
 
     Args:
       parent: TTDBTable that acts as a parent to this transaction's table
       transaction_type: A string containing the transaction type: RW (read-write) or RO (read-only)
       timestamp: Optional datetime stamp to use for read and write stamps from this transaction.  One should always be given when nesting and one will be created when not nesting.
+      track_reads: (keyword) A boolean representing whether reads update read stamps.  Should be set unless no writer could commit before this transaction's timestamp.
     """
     if timestamp is None:
       self.timestamp = datetime.datetime.now()
@@ -530,6 +1542,7 @@ class TTDBTransaction(object):
       self.timestamp = timestamp
     self.subtransaction = None
     self.type = transaction_type
+    self.track_reads = track_reads
     self.ttable = TTDBTable(parent)
 
   def begin(self):
@@ -541,7 +1554,7 @@ class TTDBTransaction(object):
     if self.subtransaction is not None:
       self.subtransaction.begin()
     else:
-      self.subtransaction = TTDBTransaction(self.ttable, self.type, self.timestamp)
+      self.subtransaction = TTDBTransaction(self.ttable, self.type, self.timestamp, self.track_reads)
 
   def rollback(self):
     """Rollback the transaction, collapsing nested transactions if they exist."""
@@ -554,12 +1567,34 @@ class TTDBTransaction(object):
   def commit(self):
     """Commit the transaction, collapsing nested transactions if they exist.
 
-    The commit may fail if there is a conflicting read timestamp.
+    Nested subtransactions are folded into a single write set first so the
+    parent table is only touched once.  The commit may fail if there is a
+    conflicting read timestamp, in which case nothing is written.
+
+    Returns:
+      A tuple of the table and index write sets that were committed
     """
-    if self.subtransaction is not None:
-      self.subtransaction.commit()
-      
-    self.ttable.commit()
+    table, index = self.write_set()
+    self.ttable.commit(table, index)
+    return table, index
+
+  def write_set(self):
+    """Fold this transaction and its nested subtransactions into one write set.
+
+    Every level shares the same timestamp, so a key written by a deeper
+    subtransaction simply replaces the enclosing level's bucket for it.
+
+    Returns:
+      A tuple of table and index dictionaries in TTDBTable format
+    """
+    if self.subtransaction is None:
+      return self.ttable.table, self.ttable.index
+    table, index = self.subtransaction.write_set()
+    folded_table = dict(self.ttable.table)
+    folded_table.update(table)
+    folded_index = dict(self.ttable.index)
+    folded_index.update(index)
+    return folded_table, folded_index
 
   def set(self, variable, value):
     """Set variable to given the value
@@ -596,7 +1631,7 @@ class TTDBTransaction(object):
     if self.subtransaction is not None:
       return self.subtransaction.get(variable)
     else:
-      return self.ttable.read_value(variable, self.timestamp)
+      return self.ttable.read_value(variable, self.timestamp, self.track_reads)
 
   def unset(self, variable):
     """Unset given variable
@@ -632,11 +1667,21 @@ class TTDBTransaction(object):
     if self.subtransaction is not None:
       return self.subtransaction.numequalto(value)
     else:
-      return self.ttable.read_index(value, self.timestamp)
+      return self.ttable.read_index(value, self.timestamp, self.track_reads)
 
   def writeable(self):
     return self.type == 'RW'
 
+  def depth(self):
+    """Count the levels of nesting in the transaction, including itself.
+
+    Returns:
+      The number of nested transactions
+    """
+    if self.subtransaction is None:
+      return 1
+    return 1 + self.subtransaction.depth()
+
   def debug(self):
     """Print table and index dictionaries for debugging purposes."""
     if self.subtransaction is not None:
@@ -646,12 +1691,93 @@ class TTDBTransaction(object):
     self.ttable.debug()
 
 
+def parse_batch(words):
+  """Split the words of an EXEC command into its individual commands.
+
+  Commands are separated by semicolons and the batch may optionally be
+  wrapped in square brackets, e.g. [SET a 10; GET a].
+
+  Args:
+    words: A list of the words following EXEC
+
+  Returns:
+    A list of commands, each a list of words
+  """
+  text = ' '.join(words).strip()
+  if text.startswith('[') and text.endswith(']'):
+    text = text[1:-1]
+  commands = [command.split() for command in text.split(';')]
+  return [command for command in commands if len(command) > 0]
+
+
+def snapshot_read(datum):
+  """Check whether a command run outside a transaction only reads a snapshot.
+
+  Args:
+    datum: A list of the words of the command
+
+  Returns:
+    True for GET, NUMEQUALTO and BEGIN RO, with or without AT
+  """
+  return datum[0] in ('GET', 'NUMEQUALTO') or (datum[0] == 'BEGIN' and len(datum) in (2, 4) and datum[1] == 'RO')
+
+
+def parse_timestamp(text):
+  """Parse the timestamp of a time-travel read.
+
+  Args:
+    text: A string containing either seconds since the Unix epoch or a local
+      time formatted as YYYY-MM-DDTHH:MM:SS[.ffffff]
+
+  Returns:
+    The matching datetime stamp
+
+  Raises:
+    InvalidTimestampException: An exception raised when text is not a valid timestamp
+  """
+  try:
+    return datetime.datetime.fromtimestamp(float(text))
+  except (ValueError, OverflowError):
+    pass
+  for timestamp_format in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+    try:
+      return datetime.datetime.strptime(text, timestamp_format)
+    except ValueError:
+      pass
+  raise InvalidTimestampException('Invalid timestamp: %s' % text)
+
+
+def format_response(value):
+  """Format the result of a read for sending to a client.
+
+  Args:
+    value: The value read, or None if there is none
+
+  Returns:
+    A string containing the value, or NULL if there is none
+  """
+  if value is None:
+    return 'NULL'
+  return str(value)
+
+
 def main():
   parser = argparse.ArgumentParser(description='TTDB database server.')
   parser.add_argument('--socket', default='./ttdb_socket', help='location of Unix socket to connect to (default: ./ttdb_socket)')
   parser.add_argument('--pp', type=int, default=20, help='minimum time (in seconds) to wait before purging outdated entries (default: 20)')
+  parser.add_argument('--sub-buffer', type=int, default=65536, help='maximum bytes of unsent notifications per subscriber before it is dropped (default: 65536)')
+  parser.add_argument('--retain', type=float, default=0, help='seconds of history to keep for GET/NUMEQUALTO/BEGIN RO ... AT reads (default: 0)')
+  parser.add_argument('--max-connections', type=int, default=1000, help='maximum number of client connections (default: 1000)')
+  parser.add_argument('--budget', type=int, default=16, help='maximum commands run per connection per round of the server loop (default: 16)')
+  parser.add_argument('--max-pending', type=int, default=64, help='pending commands at which to stop reading from a connection (default: 64)')
+  parser.add_argument('--max-depth', type=int, default=64, help='maximum transaction nesting depth (default: 64)')
+  parser.add_argument('--high-water', type=int, default=65536, help='bytes of unsent responses at which to stop reading from a connection (default: 65536)')
+  parser.add_argument('--max-input', type=int, default=65536, help='maximum bytes of a single command before its connection is closed (default: 65536)')
+  parser.add_argument('--readers', type=int, default=0, help='number of reader processes to serve snapshot reads from (default: 0)')
   args = parser.parse_args()
-  db = TTDB(sock_addr=args.socket, purge_period=args.pp)
+  db = TTDB(sock_addr=args.socket, purge_period=args.pp, subscriber_buffer=args.sub_buffer, retain=args.retain,
+            max_connections=args.max_connections, budget=args.budget, max_pending=args.max_pending, max_depth=args.max_depth, high_water=args.high_water,
+            max_input=args.max_input, readers=args.readers)
   db.run()
 
 if __name__ == '__main__':
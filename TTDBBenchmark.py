@@ -0,0 +1,160 @@
+#!/usr/bin/python2
+
+import argparse
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+def main():
+  parser = argparse.ArgumentParser(description='TTDB read throughput benchmark.')
+  parser.add_argument('--socket', default='./ttdb_bench_socket', help='location of Unix socket for the benchmark server (default: ./ttdb_bench_socket)')
+  parser.add_argument('--readers', default='0,1,2,4', help='comma separated numbers of server reader processes to benchmark (default: 0,1,2,4)')
+  parser.add_argument('--clients', type=int, default=8, help='number of concurrent client processes (default: 8)')
+  parser.add_argument('--seconds', type=float, default=3, help='duration of each run in seconds (default: 3)')
+  parser.add_argument('--keys', type=int, default=1000, help='number of keys to load before each run (default: 1000)')
+  parser.add_argument('--writes', type=float, default=0.05, help='fraction of commands that are writes (default: 0.05)')
+  parser.add_argument('--sessions', type=float, default=0.05, help='fraction of commands that open a BEGIN RO session (default: 0.05)')
+  parser.add_argument('--session-reads', type=int, default=20, help='number of reads in each BEGIN RO session (default: 20)')
+  args = parser.parse_args()
+
+  print '%8s %12s %12s' % ('readers', 'reads/s', 'writes/s')
+  for readers in [int(i) for i in args.readers.split(',')]:
+    server = start_server(args.socket, readers)
+    try:
+      load(args.socket, args.keys)
+      reads, writes = run_clients(args, args.clients)
+    finally:
+      if server.poll() is None:
+        server.terminate()
+      server.wait()
+    print '%8d %12.0f %12.0f' % (readers, reads / args.seconds, writes / args.seconds)
+
+def start_server(sock_addr, readers, timeout=10):
+  """Start a TTDB server and wait for it to accept connections.
+
+  Args:
+    sock_addr: Location of Unix socket for the server to use
+    readers: Number of reader processes for the server to serve snapshot reads from
+    timeout: Seconds to wait for the server before giving up
+
+  Returns:
+    The server's subprocess.Popen object
+  """
+  server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'TTDB.py')
+  devnull = open(os.devnull, 'w')
+  server = subprocess.Popen([sys.executable, server_path, '--socket', sock_addr, '--readers', str(readers)], stderr=devnull)
+  deadline = time.time() + timeout
+  while True:
+    if server.poll() is not None:
+      print >>sys.stderr, 'Server exited at startup with status %d' % server.returncode
+      sys.exit(1)
+    try:
+      connect(sock_addr).close()
+      return server
+    except socket.error:
+      if time.time() > deadline:
+        server.terminate()
+        server.wait()
+        print >>sys.stderr, 'Server did not accept connections within %d seconds' % timeout
+        sys.exit(1)
+      time.sleep(0.05)
+
+def connect(sock_addr):
+  """Open a connection to the server.
+
+  Args:
+    sock_addr: Location of Unix socket to connect to
+
+  Returns:
+    The connected socket
+  """
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  sock.connect(sock_addr)
+  return sock
+
+def send(sock, command):
+  """Send a command and wait for its response.
+
+  Args:
+    sock: socket connection where to send command
+    command: A string containing the command to send
+
+  Returns:
+    The server's response
+  """
+  sock.sendall(command + ' |')
+  return sock.recv(64)
+
+def load(sock_addr, keys):
+  """Reset the server and load it with keys.
+
+  Args:
+    sock_addr: Location of Unix socket to connect to
+    keys: Number of keys to load
+  """
+  sock = connect(sock_addr)
+  send(sock, 'RESET')
+  for i in range(keys):
+    send(sock, 'SET k%d %d' % (i, i % 10))
+  sock.close()
+
+def run_clients(args, clients):
+  """Run the client processes against the server for the configured time.
+
+  Args:
+    args: The parsed command line arguments
+    clients: Number of client processes to run
+
+  Returns:
+    A tuple of the total number of reads and writes completed
+  """
+  counts = multiprocessing.Queue()
+  deadline = time.time() + args.seconds
+  processes = [multiprocessing.Process(target=client, args=(args, deadline, counts)) for i in range(clients)]
+  for process in processes:
+    process.start()
+  totals = [counts.get() for process in processes]
+  for process in processes:
+    process.join()
+  return sum([reads for reads, writes in totals]), sum([writes for reads, writes in totals])
+
+def client(args, deadline, counts):
+  """Send a read-heavy mix of commands until the deadline.
+
+  Besides single writes, a fraction of commands open a BEGIN RO session
+  doing several reads before committing.  All other reads are split evenly
+  between GET and NUMEQUALTO.
+
+  Args:
+    args: The parsed command line arguments
+    deadline: time.time() value at which to stop
+    counts: multiprocessing.Queue to put the (reads, writes) count on
+  """
+  sock = connect(args.socket)
+  reads = writes = 0
+  while time.time() < deadline:
+    roll = random.random()
+    if roll < args.writes:
+      send(sock, 'SET k%d %d' % (random.randrange(args.keys), random.randrange(10)))
+      writes += 1
+    elif roll < args.writes + args.sessions:
+      send(sock, 'BEGIN RO')
+      for i in range(args.session_reads):
+        send(sock, 'GET k%d' % random.randrange(args.keys))
+      send(sock, 'COMMIT')
+      reads += args.session_reads
+    elif roll < (1 + args.writes + args.sessions) / 2:
+      send(sock, 'GET k%d' % random.randrange(args.keys))
+      reads += 1
+    else:
+      send(sock, 'NUMEQUALTO %d' % random.randrange(10))
+      reads += 1
+  sock.close()
+  counts.put((reads, writes))
+
+if __name__ == '__main__':
+  main()
@@ -16,29 +16,48 @@ def main():
     print >>sys.stderr, msg
     sys.exit(1)
 
+  listener = None
   while True:
     line = sys.stdin.readline().split()
     if len(line) == 0:
       continue
     elif line[0].upper() == 'END' and len(line) == 1:
       sock.close()
+      if listener is not None:
+        listener.close()
       break
     elif line[0].upper() == 'SET' and len(line) == 3:
       do_set(line[1], line[2], sock)
     elif line[0].upper() == 'GET' and len(line) == 2:
       do_get(line[1], sock)
+    elif line[0].upper() == 'GET' and len(line) == 4 and line[2].upper() == 'AT':
+      do_get(line[1], sock, line[3])
     elif line[0].upper() == 'UNSET' and len(line) == 2:
       do_unset(line[1], sock)
     elif line[0].upper() == 'NUMEQUALTO' and len(line) == 2:
       do_numequalto(line[1], sock)
+    elif line[0].upper() == 'NUMEQUALTO' and len(line) == 4 and line[2].upper() == 'AT':
+      do_numequalto(line[1], sock, line[3])
     elif line[0].upper() == 'BEGIN' and len(line) == 1:
       do_begin(sock, 'RW')
     elif line[0].upper() == 'BEGIN' and len(line) == 2 and line[1].upper() in ['RW', 'RO']:
       do_begin(sock, line[1])
+    elif line[0].upper() == 'BEGIN' and len(line) == 4 and line[1].upper() == 'RO' and line[2].upper() == 'AT':
+      do_begin(sock, line[1], line[3])
     elif line[0].upper() == 'ROLLBACK' and len(line) == 1:
       do_rollback(sock)
     elif line[0].upper() == 'COMMIT' and len(line) == 1:
       do_commit(sock)
+    elif line[0].upper() == 'EXEC' and len(line) > 1:
+      do_exec(' '.join(line[1:]), sock)
+    elif line[0].upper() in ['SUBSCRIBE', 'PSUBSCRIBE'] and len(line) > 1:
+      do_subscribe(line[0].upper(), line[1:], sock)
+    elif line[0].upper() == 'STATS' and len(line) <= 2:
+      do_stats(sock, *line[1:])
+    elif line[0].upper() == 'PIPELINE' and len(line) > 1:
+      do_pipeline(args.socket, ' '.join(line[1:]))
+    elif line[0].upper() == 'LISTEN':
+      listener = do_listen(listener, args.socket, ' '.join(line[1:]))
     elif line[0].upper() == 'RESET' and len(line) == 1:
       do_reset(sock)
     elif line[0].upper() == 'DEBUG' and len(line) == 1:
@@ -59,14 +78,18 @@ def do_set(variable, value, sock):
   if msg != 'success':
     print msg
 
-def do_get(variable, sock):
+def do_get(variable, sock, timestamp=None):
   """Send GET command to server.
 
   Args:
     variable: variable whose value to get
     sock: socket connection where to send command
+    timestamp: optional past time at which to get the value
   """
-  sock.sendall(" ".join(('GET', variable, '|')))
+  if timestamp is None:
+    sock.sendall(" ".join(('GET', variable, '|')))
+  else:
+    sock.sendall(" ".join(('GET', variable, 'AT', timestamp, '|')))
   print sock.recv(64)
 
 def do_unset(variable, sock):
@@ -80,24 +103,32 @@ def do_unset(variable, sock):
   msg = sock.recv(64)
   if msg != 'success': print msg
 
-def do_numequalto(value, sock):
+def do_numequalto(value, sock, timestamp=None):
   """Send NUMEQUALTO command to server.
 
   Args:
     value: the value to count
     sock: socket connection where to send command
+    timestamp: optional past time at which to count
   """
-  sock.sendall(" ".join(('NUMEQUALTO', value, '|')))
+  if timestamp is None:
+    sock.sendall(" ".join(('NUMEQUALTO', value, '|')))
+  else:
+    sock.sendall(" ".join(('NUMEQUALTO', value, 'AT', timestamp, '|')))
   print sock.recv(64)
 
-def do_begin(sock, transaction_type):
+def do_begin(sock, transaction_type, timestamp=None):
   """Send BEGIN command to server.
 
   Args:
     sock: socket connection where to send command
+    transaction_type: RW or RO
+    timestamp: optional past time for a read-only transaction to read at
   """
   if transaction_type.upper() == 'RW':
     sock.sendall('BEGIN RW |')
+  elif transaction_type.upper() == 'RO' and timestamp is not None:
+    sock.sendall(" ".join(('BEGIN RO AT', timestamp, '|')))
   elif transaction_type.upper() == 'RO':
     sock.sendall('BEGIN RO |')
   msg = sock.recv(64)
@@ -126,6 +157,122 @@ def do_commit(sock):
   if msg != 'success':
     print msg
 
+def do_exec(batch, sock):
+  """Send EXEC command to server.
+
+  Args:
+    batch: semicolon separated commands to run atomically, optionally wrapped in square brackets
+    sock: socket connection where to send command
+  """
+  batch = batch.strip()
+  if batch.startswith('[') and batch.endswith(']'):
+    batch = batch[1:-1]
+  commands = [command.split() for command in batch.split(';')]
+  commands = [" ".join([command[0].upper()] + command[1:]) for command in commands if len(command) > 0]
+  sock.sendall(" ".join(('EXEC', '[' + "; ".join(commands) + ']', '|')))
+  for msg in sock.recv(4096).split('\n'):
+    if msg != 'success':
+      print msg
+
+def do_subscribe(command, patterns, sock):
+  """Send SUBSCRIBE or PSUBSCRIBE command to server and print changes as they arrive.
+
+  Never returns; the connection stays subscribed until the server closes it.
+
+  Args:
+    command: SUBSCRIBE or PSUBSCRIBE
+    patterns: list of keys, or of key prefixes each followed by '*'
+    sock: socket connection where to send command
+  """
+  sock.sendall(" ".join([command] + patterns + ['|']))
+  while True:
+    msg = sock.recv(4096)
+    if not msg:
+      sys.exit(0)
+    for line in msg.splitlines():
+      if line != 'success':
+        print line
+    sys.stdout.flush()
+
+def do_stats(sock, name=None):
+  """Send STATS command to server.
+
+  Args:
+    sock: socket connection where to send command
+    name: optional name of the single metric to print
+  """
+  if name is None:
+    sock.sendall('STATS |')
+  else:
+    sock.sendall('STATS %s |' % name)
+  print sock.recv(4096)
+
+def do_pipeline(sock_addr, commands):
+  """Send several commands to server in one write on a new connection.
+
+  The connection is shut down for writing straight after, so the server sees
+  the end of input while the commands are still pending.  Prints every
+  response received before the server closes the connection.
+
+  Args:
+    sock_addr: Location of Unix socket to connect to
+    commands: string of commands separated by semicolons
+  """
+  messages = []
+  for command in commands.split(';'):
+    words = command.split()
+    if words:
+      messages.append(' '.join([words[0].upper()] + words[1:] + ['|']))
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  sock.connect(sock_addr)
+  sock.sendall(''.join(messages))
+  sock.shutdown(socket.SHUT_WR)
+  response = ''
+  while True:
+    msg = sock.recv(4096)
+    if not msg:
+      break
+    response += msg
+  sock.close()
+  print response
+
+def do_listen(listener, sock_addr, commands):
+  """Send commands on a second connection kept open for subscriptions and print what it has received.
+
+  The first LISTEN opens the connection.  Each LISTEN sends the given
+  commands, then an invalid "PSUBSCRIBE sync" whose error is answered after
+  every message already due to the connection, and prints every line
+  received before that error except plain successes.
+
+  Args:
+    listener: the connection opened by an earlier LISTEN, or None
+    sock_addr: Location of Unix socket to connect to
+    commands: string of commands separated by semicolons
+
+  Returns:
+    The listening connection
+  """
+  if listener is None:
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.connect(sock_addr)
+  messages = []
+  for command in commands.split(';') + ['PSUBSCRIBE sync']:
+    words = command.split()
+    if words:
+      messages.append(' '.join([words[0].upper()] + words[1:] + ['|']))
+  listener.sendall(''.join(messages))
+  marker = 'Invalid prefix pattern: sync'
+  response = ''
+  while not response.rstrip('\n').endswith(marker):
+    msg = listener.recv(4096)
+    if not msg:
+      break
+    response += msg
+  for line in response.rstrip('\n')[:-len(marker)].splitlines():
+    if line != 'success':
+      print line
+  return listener
+
 def do_reset(sock):
   """Send RESET command to server.
 
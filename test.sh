@@ -1,20 +1,29 @@
 #!/bin/bash
 
-if [[ (( $# == 1 )) && (( $1 > 0 )) && (( $1 < 7 )) ]]
+run_test() {
+	if [[ -e $1.py ]]
+	then
+		./$1.py | diff $1.out -
+	else
+		./TTDBClient.py < $1.in | diff $1.out -
+	fi
+}
+
+if [[ (( $# == 1 )) && (( $1 > 0 )) && (( $1 < 14 )) ]]
 then
-	./TTDBClient.py < test$1.in | diff test$1.out -
-elif [[ (( $# == 1 )) && -e $1.in && -e $1.out ]]
+	run_test test$1
+elif [[ (( $# == 1 )) && (-e $1.in || -e $1.py) && -e $1.out ]]
 then
-	./TTDBClient.py < $1.in | diff $1.out -
+	run_test $1
 elif [[ (($# == 0)) ]]
 then
   i=1
-  while [[ -e test$i.in && -e test$i.out ]]
+  while [[ (-e test$i.in || -e test$i.py) && -e test$i.out ]]
   do
     echo "Test $i"
-    ./TTDBClient.py < test$i.in | diff test$i.out -
+    run_test test$i
     i=$((i + 1))
   done
 else
-	echo "Must pass either a test number (1-6) or a test filename as a parameter."
+	echo "Must pass either a test number (1-13) or a test filename as a parameter."
 fi
@@ -0,0 +1,69 @@
+#!/usr/bin/python2
+
+import argparse
+import socket
+
+def main():
+  """Check that a subscriber that stops reading is dropped and counted.
+
+  A subscriber to one key never reads while another connection keeps
+  setting that key to a long value, until the server has more unsent
+  notifications for it than --sub-buffer allows.
+  """
+  parser = argparse.ArgumentParser(description='TTDB slow subscriber test.')
+  parser.add_argument('--socket', default='./ttdb_socket', help='location of Unix socket to connect to (default: ./ttdb_socket)')
+  args = parser.parse_args()
+
+  sock = connect(args.socket)
+  print send(sock, 'RESET')
+  subscriber = connect(args.socket)
+  subscriber.sendall('SUBSCRIBE slow |')
+  print subscriber.recv(64).strip()
+
+  value = 'x' * 4096
+  for i in range(1024):
+    send(sock, 'SET slow %s%d' % (value, i))
+    if send(sock, 'STATS subscribers_dropped') != '0':
+      break
+  print 'subscribers_dropped', send(sock, 'STATS subscribers_dropped')
+
+  while True:
+    try:
+      msg = subscriber.recv(65536)
+    except socket.error:
+      break
+    if not msg:
+      break
+  print 'subscriber closed'
+  print send(sock, 'GET fast')
+  subscriber.close()
+  sock.close()
+
+def connect(sock_addr):
+  """Open a connection to the server.
+
+  Args:
+    sock_addr: Location of Unix socket to connect to
+
+  Returns:
+    The connected socket
+  """
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  sock.connect(sock_addr)
+  return sock
+
+def send(sock, command):
+  """Send a command and wait for its response.
+
+  Args:
+    sock: socket connection where to send command
+    command: A string containing the command to send
+
+  Returns:
+    The server's response
+  """
+  sock.sendall(command + ' |')
+  return sock.recv(8192)
+
+if __name__ == '__main__':
+  main()